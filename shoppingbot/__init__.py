@@ -7,7 +7,9 @@ import asyncio
 import argparse
 import functools
 import argcomplete
-from .bot import ShoppingBot
+from .bot import ShoppingBot, store
+from .maintenance import Maintenance, DAY
+from .profiling import profiler
 
 
 _DEFAULT_LOG_FORMAT = "%(name)s : %(threadName)s : %(levelname)s : %(message)s"
@@ -22,9 +24,26 @@ class ShoppingBotApp(object):
         args = self._parseArguments(args)
         logging.getLogger().setLevel(args.verbosity)
         logging.info("Shopping List Bot is starting up")
-        self._bot = ShoppingBot(args.token)
+        try:
+            profiler.configure( rate = args.profile_rate
+                              , output = args.profile_output
+                              , slow = args.profile_slow / 1000.0
+                              )
+        except ValueError as e:
+            logging.error("Illegal argument(s): {0}".format(e))
+            raise e
+        if args.profile:
+            profiler.start()
+        self._bot = ShoppingBot(args.token, live_list=args.live_list)
         self._loop = asyncio.get_event_loop()
         self._loop.create_task(self._bot.message_loop())
+        self._maintenance = Maintenance( store
+                                       , chat_ttl = args.retain_chats * DAY
+                                       , checked_ttl = args.retain_checked * DAY
+                                       , interval = args.maintenance_interval * 60
+                                       , on_change = self._bot.listChanged
+                                       )
+        self._loop.create_task(self._maintenance.run())
         logging.debug("Listening for events")
 
     def _parseArguments(self, args):
@@ -39,6 +58,44 @@ class ShoppingBotApp(object):
                            , action = 'store_const'
                            , const = logging.ERROR
                            )
+        parser.add_argument( '--live-list'
+                           , dest = 'live_list'
+                           , action = 'store_true'
+                           , help = "Edit the last /list message in place on changes"
+                           )
+        parser.add_argument( '--profile'
+                           , action = 'store_true'
+                           , help = "Profile sampled updates (toggle with SIGUSR1)"
+                           )
+        parser.add_argument( '--profile-rate'
+                           , type = float
+                           , default = 0.1
+                           , help = "Fraction of updates to profile"
+                           )
+        parser.add_argument( '--profile-output'
+                           , default = "shoppingbot.folded"
+                           , help = "Collapsed-stack output file for flamegraphs"
+                           )
+        parser.add_argument( '--profile-slow'
+                           , type = float
+                           , default = 500
+                           , help = "Log profiled updates slower than this (ms)"
+                           )
+        parser.add_argument( '--retain-chats'
+                           , type = float
+                           , default = 180
+                           , help = "Purge chats inactive for this many days (0 = never)"
+                           )
+        parser.add_argument( '--retain-checked'
+                           , type = float
+                           , default = 30
+                           , help = "Purge checked items older than this many days (0 = never)"
+                           )
+        parser.add_argument( '--maintenance-interval'
+                           , type = float
+                           , default = 60
+                           , help = "Minutes between background maintenance runs"
+                           )
         parser.add_argument('token')
         parser.set_defaults(verbosity=logging.INFO)
         try:
@@ -51,12 +108,18 @@ class ShoppingBotApp(object):
 
     def _quit(self, signum):
         logging.info("Shutting down due to signal {}".format(signum))
+        profiler.stop()
+        self._maintenance.flushSeen()
         self._loop.stop()
 
+    def _toggleProfiling(self):
+        profiler.toggle()
+
     def run_forever(self):
         self._loop.add_signal_handler( signal.SIGINT
                                      , functools.partial(self._quit, 'SIGINT')
                                      )
+        self._loop.add_signal_handler(signal.SIGUSR1, self._toggleProfiling)
         self._loop.run_forever()
 
 
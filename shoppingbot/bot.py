@@ -2,7 +2,12 @@ import logging
 import inspect
 import asyncio
 import telepot
-from telepot import glance, message_identifier
+from telepot import glance, flavor, is_event, message_identifier
+from telepot.exception import ( TelegramError
+                               , TooManyRequestsError
+                               , BotWasKickedError
+                               , BotWasBlockedError
+                               )
 from telepot.namedtuple import ( InlineKeyboardMarkup
                                , InlineKeyboardButton
                                , ReplyKeyboardMarkup
@@ -16,8 +21,10 @@ from telepot.aio.delegate import ( pave_event_space
                                  , include_callback_query_chat_id
                                  )
 from .store import TinyStorage
+from .timewheel import TimerWheel
+from .profiling import profiler
 
-store = TinyStorage('lists.json')
+store = profiler.wrapStorage(TinyStorage('lists.json'))
 
 
 def get_chat_id(msg):
@@ -30,19 +37,260 @@ def get_chat_id(msg):
 
 
 class FlexibleIdleEventCoordinator(telepot.aio.helper.IdleEventCoordinator):
+    """ Idle timeout driven by a shared timer wheel
+
+    Activity (`refresh` or `delay_once`) only records a new deadline; the
+    shared `TimerWheel` expires idle handlers in batches and emits the usual
+    `_idle` event for them.
+    """
+    wheel = TimerWheel()
+
+    def __init__(self, scheduler, timeout):
+        super(FlexibleIdleEventCoordinator, self).__init__(scheduler, timeout)
+        self.deadline = None
+        self.slot = None
+        self._seconds = timeout
+
+    def refresh(self):
+        self.delay_once(self._timeout_seconds)
+
     def delay_once(self, timeout):
-        try:
-            if self._timeout_event:
+        self._seconds = timeout
+        self.wheel.update(self, self.wheel.time() + timeout)
+
+    def expire(self):
+        self._timeout_event = self._scheduler.event_now \
+                ( ( '_idle'
+                  , {'seconds': self._seconds}
+                  )
+                )
+
+    def augment_on_message(self, handler):
+        async def augmented(msg):
+            if not is_event(msg):
+                self.refresh()
+            elif (flavor(msg) == '_idle') and (self.deadline is not None):
+                # activity arrived after the timer fired -> stale event
+                logging.debug("Ignoring stale idle event")
+                return
+            return await handler(msg)
+        return augmented
+
+    def augment_on_close(self, handler):
+        async def augmented(ex):
+            self.wheel.cancel(self)
+            if self._timeout_event is not None:
                 self._scheduler.cancel(self._timeout_event)
-        except exception.EventNotFound:
-            pass
+                self._timeout_event = None
+            return await handler(ex)
+        return augmented
+
+
+def format_checklist(chklst):
+    for id,txt,checked in sorted(chklst, key=lambda x: x[0]):
+        if checked:
+            yield " - [x] {0}".format(txt)
+        else:
+            yield " - [ ] {0}".format(txt)
+
+
+def render_list(lid):
+    global store
+    chklst = store.getCheckList(lid)
+    with profiler.phase('render'):
+        l = list(format_checklist(chklst))
+    if l:
+        return "Your shopping list:\n\n{}".format("\n".join(l))
+    else:
+        return "Your shopping list is empty \U0001F600"
+
+
+def list_keyboard(lid, exclude=tuple()):
+    global store
+    cls = InlineKeyboardButton
+    items = store.enum(lid)
+    with profiler.phase('render'):
+        ikb = list([[cls(text=v, callback_data=str(k))]
+                     for k,v in items if k not in exclude
+                  ])
+    if ikb:
+        return InlineKeyboardMarkup(inline_keyboard=ikb)
+    else:
+        return None
+
+
+class LiveList(object):
+    """ Keeps one list message per chat up to date by editing it in place
+
+    Edits are skipped if the rendered text didn't change. At most one edit
+    per chat is in flight; changes arriving meanwhile are picked up by it, so
+    an older text can never overwrite a newer one. The message is only
+    forgotten if it can't be edited anymore; other failures are retried
+    through the bot's `ListFanout`.
+    """
+    RETRY = 30
+    # descriptions of errors after which the live message is useless
+    GONE = ( "message to edit not found"
+           , "message can't be edited"
+           , "message_id_invalid"
+           , "chat not found"
+           )
+
+    def __init__(self, bot):
+        self._bot = bot
+        self._rendered = dict()  # cid -> text of the live message
+        self._wanted = dict()    # cid -> text the live message should show
+        self._busy = set()       # cids with an edit in flight
+
+    async def send(self, sender, cid, lid):
+        global store
+        txt = render_list(lid)
+        msg = await sender.sendMessage(txt)
+        store.setLiveMessage(cid, message_identifier(msg))
+        self._rendered[cid] = txt
+        self._wanted[cid] = txt
+
+    async def update(self, lid, txt):
+        global store
+        for cid in store.subscribers(lid):
+            self._wanted[cid] = txt
+            if cid in self._busy:
+                logging.debug("Live list of {0} is being edited".format(cid))
+                continue
+            await self._edit(lid, cid)
+
+    def _isGone(self, e):
+        if isinstance(e, (BotWasKickedError, BotWasBlockedError)):
+            return True
+        description = str(e.description).lower()
+        return any([i in description for i in self.GONE])
+
+    def _retryAfter(self, e):
+        try:
+            return int(e.json['parameters']['retry_after'])
+        except (KeyError, TypeError, ValueError):
+            return self.RETRY
+
+    async def _edit(self, lid, cid):
+        global store
+        self._busy.add(cid)
+        try:
+            while self._rendered.get(cid) != self._wanted.get(cid):
+                txt = self._wanted[cid]
+                msg_id = store.getLiveMessage(cid)
+                if msg_id is None:
+                    return
+                try:
+                    await self._bot.editMessageText(msg_id, txt)
+                    self._rendered[cid] = txt
+                except TelegramError as e:
+                    if 'not modified' in str(e.description):
+                        self._rendered[cid] = txt
+                    elif self._isGone(e):
+                        logging.warning("Dropping live list of {0}: {1}".format\
+                                (cid, e.description))
+                        store.setLiveMessage(cid, None)
+                        self._rendered.pop(cid, None)
+                        self._wanted.pop(cid, None)
+                        return
+                    else:
+                        delay = self.RETRY
+                        if isinstance(e, TooManyRequestsError):
+                            delay = self._retryAfter(e)
+                        logging.warning("Editing live list of {0} failed, retry in {1}s: {2}".format\
+                                (cid, delay, e.description))
+                        self._bot.fanout.retry(lid, delay)
+                        return
+                except Exception:
+                    logging.exception("Editing live list of {0} failed".format(cid))
+                    self._bot.fanout.retry(lid, self.RETRY)
+                    return
         finally:
-            self._timeout_event = self._scheduler.event_later \
-                    ( timeout
-                    , ( '_idle'
-                      , {'seconds': timeout}
-                      )
-                    )
+            self._busy.discard(cid)
+
+
+class ListFanout(object):
+    """ Pushes list changes to all chats subscribed to the list
+
+    Mutations only mark a list as changed. After `DELAY` seconds the list is
+    rendered once and pushed to the open shopping dialogs and live messages
+    of its subscribers, so a burst of changes from any number of chats costs
+    at most one update per subscribed chat. Only one push per list runs at a
+    time; a change arriving meanwhile triggers one more push afterwards.
+    """
+    DELAY = 2.0
+
+    def __init__(self, bot, live=None, delay=None):
+        self._bot = bot
+        self._live = live
+        self._delay = self.DELAY if delay is None else delay
+        self._pending = dict()   # lid -> scheduled flush
+        self._watchers = dict()  # lid -> open shopping dialogs
+        self._running = set()    # lids with a push in flight
+        self._dirty = set()      # lids changed during their push
+
+    def watch(self, lid, dialog):
+        self._watchers.setdefault(lid, set()).add(dialog)
+
+    def watching(self, lid, dialog):
+        return dialog in self._watchers.get(lid, ())
+
+    def unwatch(self, lid, dialog):
+        dialogs = self._watchers.get(lid)
+        if dialogs is not None:
+            dialogs.discard(dialog)
+            if not dialogs:
+                del self._watchers[lid]
+
+    def changed(self, lid):
+        if lid in self._pending:
+            return
+        if (self._live is None) and (lid not in self._watchers):
+            return
+        self._pending[lid] = self._bot.loop.call_later \
+                ( self._delay
+                , self._flush
+                , lid
+                , context = profiler.detached()
+                )
+
+    def retry(self, lid, delay):
+        """ Push `lid` again after `delay` seconds, e.g. after a failed edit """
+        self._bot.loop.call_later( delay
+                                 , self.changed
+                                 , lid
+                                 , context = profiler.detached()
+                                 )
+
+    def _flush(self, lid):
+        self._pending.pop(lid, None)
+        if lid in self._running:
+            self._dirty.add(lid)
+            return
+        self._running.add(lid)
+        self._bot.loop.create_task(self._push(lid))
+
+    async def _push(self, lid):
+        try:
+            while True:
+                self._dirty.discard(lid)
+                try:
+                    await self._pushOnce(lid)
+                except Exception:
+                    logging.exception("Pushing list {0} failed".format(lid))
+                if lid not in self._dirty:
+                    break
+        finally:
+            self._running.discard(lid)
+
+    async def _pushOnce(self, lid):
+        dialogs = list(self._watchers.get(lid, ()))
+        if dialogs:
+            kb = list_keyboard(lid)
+            for dialog in dialogs:
+                await dialog.refresh(kb)
+        if self._live is not None:
+            await self._live.update(lid, render_list(lid))
 
 
 class Dialog(object):
@@ -52,6 +300,7 @@ class Dialog(object):
         self._active = True
         self._state = self.on_start
         self.cid = None        # current chat id available in callback
+        self.lid = None        # id of the list the chat uses, available in callback
         self.sender = None     # sender available in callback
         self.handler = None    # handler available in callback
         self.bot = None
@@ -68,6 +317,9 @@ class Dialog(object):
         except AttributeError:
             logging.debug("Delaying timeout is not supported by handler {0!r}".format(self.handler))
 
+    def changed(self):
+        self.bot.listChanged(self.lid)
+
     def _getStateName(self, method):
         for k,v in self._states.items():
             if method == v:
@@ -83,6 +335,8 @@ class Dialog(object):
                 self.cid = get_chat_id(msg)
             except KeyError:
                 logging.debug("Couldn't get cid; keep old {}".format(self.cid))
+            if self.cid is not None:
+                self.lid = store.listOf(self.cid)
             self.handler = handler
             self.sender = handler.sender
             self.bot = handler.bot
@@ -155,7 +409,8 @@ class AddItemDialog(Dialog):
 
     async def on_add(self, msg):
         global store
-        store.addItem(self.cid, msg['text'])
+        store.addItem(self.lid, msg['text'])
+        self.changed()
         self._count += 1
         self.delay_once(self.ADD_TIMEOUT)
         await self.sender.sendMessage("Added item {text}".format(**msg))
@@ -174,17 +429,33 @@ class ShoppingDialog(Dialog):
     def __init__(self):
         Dialog.__init__(self)
         self._editor = None
+        self._kb = None
+        self._kb_lock = asyncio.Lock()
 
     def _prepare_kb(self):
-        global store
-        cls = InlineKeyboardButton
-        ikb = list([[cls(text=v, callback_data=str(k))]
-                     for k,v in store.enum(self.cid)
-                  ])
-        if ikb:
-            return InlineKeyboardMarkup(inline_keyboard=ikb)
-        else:
-            return None
+        return list_keyboard(self.lid)
+
+    async def _showKeyboard(self, kb):
+        """ All keyboard edits go through here, one at a time """
+        async with self._kb_lock:
+            if (self._editor is None) or (kb == self._kb):
+                return
+            if (kb is not None) and not self.isActive():
+                return
+            await self._editor.editMessageReplyMarkup(reply_markup=kb)
+            self._kb = kb
+
+    async def refresh(self, kb):
+        """ Show a list change made by another chat """
+        if not (self.isActive() and self.bot.fanout.watching(self.lid, self)):
+            return
+        try:
+            await self._showKeyboard(kb)
+        except TelegramError as e:
+            logging.warning("Couldn't refresh keyboard of {0}: {1}".format\
+                    (self.cid, e.description))
+        except Exception:
+            logging.exception("Refreshing keyboard of {0} failed".format(self.cid))
 
     async def on_start(self, msg):
         kb = self._prepare_kb()
@@ -205,6 +476,8 @@ class ShoppingDialog(Dialog):
         self._editor = telepot.aio.helper.Editor( self.bot
                                                 , kb_id
                                                 )
+        self._kb = kb
+        self.bot.fanout.watch(self.lid, self)
         return self.on_select
 
     async def on_select(self, msg):
@@ -213,30 +486,47 @@ class ShoppingDialog(Dialog):
             logging.error("ignoring message {0!r}".format(msg))
             return None
         logging.debug("delete key={0}".format(self.query_key))
-        ret, r = store.checkItem(self.cid, self.query_key)
+        ret, r = store.checkItem(self.lid, self.query_key)
         self.delay_once(self.SHOP_TIMEOUT)
-        if r is not None:
+        if r is None:
+            # removed by another chat sharing the list (or by retention)
             await self.bot.answerCallbackQuery \
                     ( self.query_id
-                    , text = "Ticked off {}".format(r['item'])
+                    , text = "Item was removed"
                     )
+            await self._showKeyboard(self._prepare_kb())
+            return None
+        self.changed()
+        await self.bot.answerCallbackQuery \
+                ( self.query_id
+                , text = "Ticked off {}".format(r['item'])
+                )
         if r.get('checked', 0) == 1:
             logging.debug("Item was already checked -> ignoring")
         else:  # wasn't already checked
             kb = self._prepare_kb()
-            await self._editor.editMessageReplyMarkup(reply_markup=kb)
+            await self._showKeyboard(kb)
             if kb is None:
-                chk_list = [ "- {0}".format(i) for i in store.getList(self.cid, checked=True)]
+                chk_list = [ "- {0}".format(i) for i in store.getList(self.lid, checked=True)]
                 txt = "Shopping list done\n\n{0}".format("\n".join(chk_list))
-                store.removeChecked(self.cid)
-                await self._editor.editMessageText(text=txt)
-                self._editor = None
+                store.removeChecked(self.lid)
+                self.changed()
+                async with self._kb_lock:
+                    await self._editor.editMessageText(text=txt)
+                    self._editor = None
                 await self.close(self.handler)
         return None
 
     async def on_close(self, *args):
-        if self._editor is not None:
-            await self._editor.editMessageReplyMarkup(reply_markup=None)
+        self.bot.fanout.unwatch(self.lid, self)
+        async with self._kb_lock:
+            try:
+                if self._editor is not None:
+                    await self._editor.editMessageReplyMarkup(reply_markup=None)
+            finally:
+                # a push already in progress must not bring the keyboard back
+                self._editor = None
+                self._kb = None
 
 
 class SwapDialog(Dialog):
@@ -247,16 +537,7 @@ class SwapDialog(Dialog):
         self._key = [None, None]
 
     def _prepare_kb(self, exclude=tuple()):
-        global store
-        cls = InlineKeyboardButton
-        ikb = list()
-        for k,v in store.enum(self.cid):
-            if k not in exclude:
-                ikb.append([cls(text=v, callback_data=str(k))])
-        if ikb:
-            return InlineKeyboardMarkup(inline_keyboard=ikb)
-        else:
-            return None
+        return list_keyboard(self.lid, exclude=exclude)
 
     async def on_start(self, msg):
         kb = self._prepare_kb()
@@ -309,18 +590,44 @@ class SwapDialog(Dialog):
                     ( self.query_id
                     , text = "Abort swap command"
                     )
-        else:
-            logging.debug("Swapping {0} and {1}".format(*self._key))
+        elif store.swapItems(self.lid, self._key[0], self._key[1]):
+            logging.debug("Swapped {0} and {1}".format(*self._key))
+            self.changed()
             await self.bot.answerCallbackQuery \
                     ( self.query_id
                     , text = "Swap {0} and {1}".format(*self._key)
                     )
-        store.swapItems(self.cid, self._key[0], self._key[1])
+        else:
+            # ticked off or removed by another chat sharing the list
+            await self.bot.answerCallbackQuery \
+                    ( self.query_id
+                    , text = "Item was removed"
+                    )
         kb = self._prepare_kb()
         await self._editor.editMessageReplyMarkup(reply_markup=kb)
         return self.on_select_1
 
 
+class JoinDialog(Dialog):
+    JOIN_TIMEOUT = 60 * 5
+
+    async def on_start(self, msg):
+        self.delay_once(self.JOIN_TIMEOUT)
+        await self.sender.sendMessage("Please send the share code of the list:")
+        return self.on_code
+
+    async def on_code(self, msg):
+        global store
+        self.delay_once(self.JOIN_TIMEOUT)
+        lid = store.joinList(self.cid, msg['text'].strip())
+        if lid is None:
+            await self.sender.sendMessage("Unknown share code, please try again")
+            return None
+        await self.sender.sendMessage("You are now sharing this list \U0001F600")
+        await self.close(self.handler)
+        return None
+
+
 class CommandCollection(object):
     def __init__(self):
         self._cmds = dict()
@@ -423,6 +730,18 @@ class TestHandler(telepot.aio.helper.ChatHandler):
                     , self._cleanupList
                     , help = "Remove checked items from list"
                     )
+        cc.addSimple( 'share'
+                    , self._shareList
+                    , help = "Get a code to share your list with other chats"
+                    )
+        cc.addDialog( 'join'
+                    , JoinDialog
+                    , help = "Use a list shared by another chat"
+                    )
+        cc.addSimple( 'leave'
+                    , self._leaveList
+                    , help = "Stop using a shared list"
+                    )
         cc.addSimple( 'help'
                     , self._sendHelp
                     , help = "Show help text"
@@ -433,13 +752,6 @@ class TestHandler(telepot.aio.helper.ChatHandler):
                     )
         self._cc = cc
 
-    def _format_checklist(self, chklst):
-        for id,txt,checked in sorted(chklst, key=lambda x: x[0]):
-            if checked:
-                yield " - [x] {0}".format(txt)
-            else:
-                yield " - [ ] {0}".format(txt)
-
     async def _sendList(self, msg):
         global store
         try:
@@ -448,12 +760,11 @@ class TestHandler(telepot.aio.helper.ChatHandler):
             logging.exception("Request seems wrong: {0!r}".format(msg))
             return
         store.dumpAll()
-        l = list(self._format_checklist(store.getCheckList(cid)))
-        if l:
-            await self.sender.sendMessage \
-                    ("Your shopping list:\n\n{}".format("\n".join(l)))
+        lid = store.listOf(cid)
+        if self.bot.live is not None:
+            await self.bot.live.send(self.sender, cid, lid)
         else:
-            await self.sender.sendMessage("Your shopping list is empty \U0001F600")
+            await self.sender.sendMessage(render_list(lid))
 
     async def _cleanupList(self, msg):
         global store
@@ -462,10 +773,36 @@ class TestHandler(telepot.aio.helper.ChatHandler):
         except KeyError:
             logging.exception("Request seems wrong: {0!r}".format(msg))
             return
-        store.removeChecked(cid)
+        lid = store.listOf(cid)
+        store.removeChecked(lid)
+        self.bot.listChanged(lid)
         await self.sender.sendMessage \
                 ("Cleaned up your shopping list")
 
+    async def _shareList(self, msg):
+        global store
+        try:
+            cid = get_chat_id(msg)
+        except KeyError:
+            logging.exception("Request seems wrong: {0!r}".format(msg))
+            return
+        code = store.shareCode(store.listOf(cid))
+        await self.sender.sendMessage \
+                ("Send /join in the other chat and enter this code:\n\n{0}".format(code))
+
+    async def _leaveList(self, msg):
+        global store
+        try:
+            cid = get_chat_id(msg)
+        except KeyError:
+            logging.exception("Request seems wrong: {0!r}".format(msg))
+            return
+        if store.listOf(cid) == cid:
+            await self.sender.sendMessage("You are already using your own list")
+            return
+        store.leaveList(cid)
+        await self.sender.sendMessage("You are back on your own list")
+
     async def _sendHelp(self, msg):
         logging.debug("Bot: {0!r}".format(dir(self.bot)))
         me = await self.bot.getMe()
@@ -475,9 +812,12 @@ class TestHandler(telepot.aio.helper.ChatHandler):
     async def _sendCommandList(self, msg):
         await self.sender.sendMessage(self._cc.commandList())
 
+    @profiler.update('on_chat_message')
     async def on_chat_message(self, msg):
-        content_type, chat_type, cid = glance(msg)
+        with profiler.phase('parse'):
+            content_type, chat_type, cid = glance(msg)
         logging.debug("on_chat_message: {0!s}".format(msg))
+        store.touchChat(str(cid))
         if content_type == 'new_chat_member':
             return  # ignore
         if content_type != 'text':
@@ -485,7 +825,8 @@ class TestHandler(telepot.aio.helper.ChatHandler):
             return
         if msg['text'].startswith('/'):
             botname = await self.bot.getBotName()
-            cmd = self._cc.get(msg, botname=botname)
+            with profiler.phase('parse'):
+                cmd = self._cc.get(msg, botname=botname)
             if cmd is not None:
                 await self._dialog.close(self)
                 cmd = self._cc.get(msg)
@@ -506,18 +847,24 @@ class TestHandler(telepot.aio.helper.ChatHandler):
         else: # ignore
             logging.warning("Bot ignores message: {text}".format(**msg))
 
+    @profiler.update('on_callback_query')
     async def on_callback_query(self, msg):
         logging.debug("on_callback_query: {0!s}".format(msg))
+        try:
+            store.touchChat(get_chat_id(msg))
+        except KeyError:
+            pass
         if self._dialog.isActive():
             await self._dialog(msg, self, callback=True)
 
+    @profiler.update('on_close')
     async def on_close(self, ex):
         self._log.debug("Closing TestHandler ...")
         await self._dialog.close(self)
 
 
 class ShoppingBot(telepot.aio.DelegatorBot):
-    def __init__(self, token):
+    def __init__(self, token, live_list=False):
         self._log = logging.getLogger('ShoppingBot')
         super(ShoppingBot, self).__init__ \
                 ( token
@@ -534,6 +881,15 @@ class ShoppingBot(telepot.aio.DelegatorBot):
                 , ]
                 )
         self._botname = None
+        self.live = LiveList(self) if live_list else None
+        self.fanout = ListFanout(self, live=self.live)
+
+    async def _api_request(self, *args, **kwargs):
+        with profiler.phase('api'):
+            return await super(ShoppingBot, self)._api_request(*args, **kwargs)
+
+    def listChanged(self, lid):
+        self.fanout.changed(lid)
 
     async def getBotName(self):
         if self._botname is None:
@@ -0,0 +1,138 @@
+import time
+import asyncio
+import logging
+
+
+DAY = 24 * 60 * 60
+
+
+class Maintenance(object):
+    """ Background retention for the list store
+
+    Every `interval` seconds the store is scanned once; chats without any
+    activity for `chat_ttl` seconds and checked items older than
+    `checked_ttl` seconds are then removed in batches of at most `batch`
+    entries with a `pause` between them, so a purge never blocks the event
+    loop for long. Writing back chat activity and scanning the store (in
+    chunks of `scan_chunk` documents) are split up the same way. A TTL of 0
+    disables that part of the purge. `on_change` is called with the id of
+    every list that lost checked items.
+    """
+
+    def __init__( self, storage
+                , chat_ttl=180 * DAY
+                , checked_ttl=30 * DAY
+                , interval=60 * 60
+                , batch=50
+                , pause=1.0
+                , scan_chunk=1000
+                , on_change=None
+                ):
+        self._store = storage
+        self._chat_ttl = chat_ttl
+        self._checked_ttl = checked_ttl
+        self._interval = interval
+        self._batch = batch
+        self._pause = pause
+        self._scan_chunk = scan_chunk
+        self._on_change = on_change
+        self._log = logging.getLogger('Maintenance')
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self._interval)
+            try:
+                await self.runOnce()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                self._log.exception("Maintenance run failed")
+
+    def _batches(self, eids):
+        eids = list(eids)
+        for i in range(0, len(eids), self._batch):
+            yield eids[i:i + self._batch]
+
+    def _splitSeen(self, seen):
+        """ Insert activity of chats without 'seen' document, return the
+        eids of the documents that still need an update """
+        existing = self._store.seenEntries()
+        new = dict([(cid, ts) for cid, ts in seen.items() if cid not in existing])
+        if new:
+            self._store.insertSeen(new)
+        return [existing[cid] for cid in seen if cid in existing]
+
+    async def _flushSeen(self):
+        seen = self._store.takeSeen()
+        if not seen:
+            return
+        try:
+            for eids in self._batches(self._splitSeen(seen)):
+                await asyncio.sleep(self._pause)
+                self._store.updateSeen(eids, seen)
+        except BaseException:
+            self._store.returnSeen(seen)
+            raise
+
+    def flushSeen(self):
+        """ Write back chat activity in one go, e.g. on shutdown """
+        seen = self._store.takeSeen()
+        if not seen:
+            return
+        try:
+            known = self._splitSeen(seen)
+            if known:
+                self._store.updateSeen(known, seen)
+        except Exception:
+            self._store.returnSeen(seen)
+            self._log.exception("Writing back chat activity failed")
+
+    def _activeSince(self, cid, now):
+        chats = set([cid])
+        chats.update(self._store.subscribers(cid))
+        return any([(self._store.lastSeen(i) or 0) > now for i in chats])
+
+    async def runOnce(self):
+        now = time.time()
+        await self._flushSeen()
+        if self._chat_ttl > 0:
+            chat_before = now - self._chat_ttl
+        else:
+            chat_before = 0
+        if self._checked_ttl > 0:
+            checked_before = now - self._checked_ttl
+        else:
+            checked_before = 0
+        scan = self._store.retentionScan(chat_before, checked_before)
+        while scan.step(self._scan_chunk):
+            await asyncio.sleep(self._pause)
+        abandoned, stale, unstamped = scan.result()
+        self._log.debug("Retention: {0} chats, {1} checked, {2} unstamped".format\
+                (len(abandoned), len(stale), len(unstamped)))
+        purged = set()
+        for eids in abandoned.values():
+            purged.update(eids)
+        stale = [(lid, eid) for lid, eid in stale if eid not in purged]
+        for eids in self._batches(unstamped):
+            await asyncio.sleep(self._pause)
+            self._store.stampItems(eids, now)
+        removed = 0
+        for part in self._batches(stale):
+            await asyncio.sleep(self._pause)
+            self._store.removeEntries([eid for lid, eid in part])
+            removed += len(part)
+            if self._on_change is not None:
+                for lid in set([lid for lid, eid in part]):
+                    self._on_change(lid)
+        chats = 0
+        for cid, eids in abandoned.items():
+            await asyncio.sleep(self._pause)
+            if self._activeSince(cid, now):
+                self._log.debug("Chat {0} is active again".format(cid))
+                continue
+            self._store.removeEntries(eids)
+            removed += len(eids)
+            chats += 1
+        if removed:
+            self._log.info("Purged {0} entries ({1} abandoned chats)".format\
+                    (removed, chats))
@@ -0,0 +1,213 @@
+import time
+import heapq
+import random
+import signal
+import inspect
+import logging
+import functools
+import contextlib
+import contextvars
+from collections import Counter
+
+
+_current = contextvars.ContextVar('shoppingbot_profiled_update', default=None)
+
+
+class UpdateRecord(object):
+    """ Wall clock time of one update, split into exclusive phases """
+
+    def __init__(self, label):
+        self.label = label
+        self.phases = Counter()
+        self._phase = 'other'
+        self._start = self._since = time.perf_counter()
+        self.duration = None
+
+    def switch(self, phase):
+        if self.duration is not None:
+            return None  # finished, late callers must not change it
+        now = time.perf_counter()
+        self.phases[self._phase] += now - self._since
+        prev, self._phase, self._since = self._phase, phase, now
+        return prev
+
+    def finish(self):
+        self.switch(None)
+        self.duration = time.perf_counter() - self._start
+
+    def breakdown(self):
+        return ", ".join("{0}={1:.1f}ms".format(k, v * 1000)
+                         for k,v in self.phases.most_common())
+
+
+class StorageProxy(object):
+    """ Forwards to a storage object, accounting calls to a profiler phase """
+
+    def __init__(self, storage, profiler, phase='storage'):
+        self._storage = storage
+        self._profiler = profiler
+        self._phase = phase
+
+    def __getattr__(self, name):
+        attr = getattr(self._storage, name)
+        if not callable(attr):
+            return attr
+
+        @functools.wraps(attr)
+        def timed(*args, **kwargs):
+            if _current.get() is None:
+                return attr(*args, **kwargs)
+            with self._profiler.phase(self._phase):
+                r = attr(*args, **kwargs)
+                if inspect.isgenerator(r):
+                    r = iter(list(r))
+                return r
+        # cache the wrapper, __getattr__ is only consulted for misses
+        setattr(self, name, timed)
+        return timed
+
+
+class Profiler(object):
+    """ Samples a fraction of updates
+
+    CPU stacks are collected with a SIGPROF interval timer while at least one
+    sampled update is in flight and written in collapsed-stack format (one
+    "frame;frame;frame count" line per stack), which flamegraph tools accept.
+    The slowest updates are kept together with their phase breakdown.
+    """
+    INTERVAL = 0.005
+    KEEP_SLOWEST = 10
+
+    def __init__(self):
+        self.enabled = False
+        self.rate = 0.1
+        self.output = "shoppingbot.folded"
+        self.slow = 0.5
+        self._stacks = Counter()
+        self._slowest = list()
+        self._inflight = 0
+        self._seq = 0
+
+    def configure(self, rate=None, output=None, slow=None):
+        if rate is not None:
+            if not (0.0 <= rate <= 1.0):
+                raise ValueError("Profiling rate {0} not in [0, 1]".format(rate))
+            self.rate = rate
+        if output is not None:
+            self.output = output
+        if slow is not None:
+            self.slow = slow
+
+    def start(self):
+        if not self.enabled:
+            logging.info("Profiling {0:.0%} of updates".format(self.rate))
+            self.enabled = True
+
+    def stop(self):
+        if self.enabled:
+            self.enabled = False
+            self.dump()
+
+    def toggle(self):
+        if self.enabled:
+            self.stop()
+        else:
+            self.start()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        rec = _current.get()
+        if rec is None:
+            yield
+            return
+        prev = rec.switch(name)
+        try:
+            yield
+        finally:
+            rec.switch(prev)
+
+    def detached(self):
+        """ Context for background work that must not be accounted to the
+        update that scheduled it (pass as `context` to loop.call_later) """
+        return contextvars.Context()
+
+    def wrapStorage(self, storage):
+        return StorageProxy(storage, self)
+
+    def update(self, label):
+        """ Decorator for coroutine methods handling one update """
+        def decorator(func):
+            @functools.wraps(func)
+            async def wrapped(obj, *args, **kwargs):
+                if ( (not self.enabled)
+                   or (_current.get() is not None)
+                   or (random.random() >= self.rate)
+                   ):
+                    return await func(obj, *args, **kwargs)
+                rec = UpdateRecord("{0}.{1}".format(type(obj).__name__, label))
+                token = _current.set(rec)
+                self._enter()
+                try:
+                    return await func(obj, *args, **kwargs)
+                finally:
+                    self._leave()
+                    _current.reset(token)
+                    rec.finish()
+                    self._record(rec)
+            return wrapped
+        return decorator
+
+    def _enter(self):
+        self._inflight += 1
+        if self._inflight == 1:
+            signal.signal(signal.SIGPROF, self._sample)
+            signal.setitimer(signal.ITIMER_PROF, self.INTERVAL, self.INTERVAL)
+
+    def _leave(self):
+        self._inflight -= 1
+        if self._inflight == 0:
+            signal.setitimer(signal.ITIMER_PROF, 0)
+
+    def _sample(self, signum, frame):
+        # the handler runs in the context of the interrupted task, so this
+        # skips unsampled updates and background tasks
+        if _current.get() is None:
+            return
+        stack = list()
+        while frame is not None:
+            code = frame.f_code
+            stack.append("{0}:{1}".format(code.co_filename, code.co_name))
+            frame = frame.f_back
+        self._stacks[";".join(reversed(stack))] += 1
+
+    def _record(self, rec):
+        if rec.duration >= self.slow:
+            logging.warning("Slow update {0}: {1:.1f}ms ({2})".format\
+                    (rec.label, rec.duration * 1000, rec.breakdown()))
+        self._seq += 1
+        item = (rec.duration, self._seq, rec)
+        if len(self._slowest) < self.KEEP_SLOWEST:
+            heapq.heappush(self._slowest, item)
+        else:
+            heapq.heappushpop(self._slowest, item)
+
+    def dump(self):
+        for duration, _, rec in sorted(self._slowest, reverse=True):
+            logging.info("Slowest update {0}: {1:.1f}ms ({2})".format\
+                    (rec.label, duration * 1000, rec.breakdown()))
+        if not self._stacks:
+            logging.info("No profiling samples collected")
+        else:
+            try:
+                with open(self.output, 'w') as f:
+                    for stack, count in self._stacks.items():
+                        f.write("{0} {1}\n".format(stack, count))
+                logging.info("Wrote {0} profiling samples to {1}".format\
+                        (sum(self._stacks.values()), self.output))
+            except OSError as e:
+                logging.error("Couldn't write profile {0}: {1}".format\
+                        (self.output, e))
+        self._stacks.clear()
+        self._slowest = list()
+
+profiler = Profiler()
@@ -1,3 +1,5 @@
+import time
+import uuid
 import logging
 from tinydb import TinyDB, Query
 
@@ -7,6 +9,9 @@ class TinyStorage(object):
         if path is None:
             path = "tinydb.json"
         self._db = db = TinyDB(path)
+        self._seen = dict()  # cid -> last activity, not yet written
+        self._lists = dict()        # cid -> list id
+        self._subscribers = dict()  # list id -> chat ids
         logging.debug("Load DB {}".format(path))
 
     def getList(self, cid, checked=False):
@@ -44,16 +49,24 @@ class TinyStorage(object):
         eid_b = int(eid_b)
         a = self._db.get(eid=eid_a)
         b = self._db.get(eid=eid_b)
+        if (a is None) or (b is None):
+            logging.debug("Swap of removed item: {0}, {1}".format(eid_a, eid_b))
+            return False
         if (a['cid'] != cid) or (b['cid'] != cid):
             raise RuntimeError("Invalid items selected")
+        if (a.get('checked', 0) == 1) or (b.get('checked', 0) == 1):
+            # swapping would carry the checked state over to the other item
+            logging.debug("Swap of checked item: {0}, {1}".format(eid_a, eid_b))
+            return False
         logging.debug("A: {0}".format(a))
         logging.debug("B: {0}".format(b))
         # HACK: override old item to 'fake' swapping
         self._db.update(a, eids=[eid_b])
         self._db.update(b, eids=[eid_a])
+        return True
 
     def addItem(self, cid, item):
-        self._db.insert(dict(cid=cid, item=item))
+        self._db.insert(dict(cid=cid, item=item, added=time.time()))
 
     def checkItem(self, cid, eid):
         eid = int(eid)
@@ -62,7 +75,9 @@ class TinyStorage(object):
         if r is not None:
             try:
                 if r['cid'] == cid:
-                    self._db.update(dict(checked=1), eids=[eid])
+                    self._db.update( dict(checked=1, checked_at=time.time())
+                                   , eids=[eid]
+                                   )
                     logging.debug("Check Item {0!s}".format(r))
                 else:
                     logging.error("Check not allowed: cid={0}, r={1!s}".format\
@@ -77,6 +92,178 @@ class TinyStorage(object):
                        & (Query().checked == 1)
                        )
 
+    def getLiveMessage(self, cid):
+        if not isinstance(cid, str):
+            raise TypeError("'cid' has invalid type '{0!s}'".format(type(cid)))
+        r = self._db.get((Query().cid == cid) & (Query().live.exists()))
+        if r is None:
+            return None
+        return tuple(r['live'])
+
+    def setLiveMessage(self, cid, msg_id):
+        if not isinstance(cid, str):
+            raise TypeError("'cid' has invalid type '{0!s}'".format(type(cid)))
+        query = (Query().cid == cid) & (Query().live.exists())
+        if msg_id is None:
+            self._db.remove(query)
+        elif self._db.contains(query):
+            self._db.update(dict(live=list(msg_id)), query)
+        else:
+            self._db.insert(dict(cid=cid, live=list(msg_id)))
+
+    def listOf(self, cid):
+        """ Id of the list chat `cid` is subscribed to (default: its own) """
+        if cid not in self._lists:
+            r = self._db.get((Query().cid == cid) & (Query().list.exists()))
+            self._lists[cid] = cid if r is None else r['list']
+        return self._lists[cid]
+
+    def subscribers(self, lid):
+        if lid not in self._subscribers:
+            chats = [i['cid'] for i in self._db.search(Query().list == lid)]
+            if self.listOf(lid) == lid:
+                chats.append(lid)
+            self._subscribers[lid] = chats
+        return self._subscribers[lid]
+
+    def shareCode(self, lid):
+        r = self._db.get((Query().cid == lid) & (Query().share.exists()))
+        if r is not None:
+            return r['share']
+        code = uuid.uuid4().hex[:10]
+        self._db.insert(dict(cid=lid, share=code))
+        return code
+
+    def joinList(self, cid, code):
+        r = self._db.get(Query().share == code)
+        if r is None:
+            return None
+        self._setList(cid, r['cid'])
+        return r['cid']
+
+    def leaveList(self, cid):
+        self._setList(cid, cid)
+
+    def _setList(self, cid, lid):
+        query = (Query().cid == cid) & (Query().list.exists())
+        if lid == cid:
+            self._db.remove(query)
+        elif self._db.contains(query):
+            self._db.update(dict(list=lid), query)
+        else:
+            self._db.insert(dict(cid=cid, list=lid))
+        self._lists.clear()
+        self._subscribers.clear()
+
+    def touchChat(self, cid):
+        self._seen[cid] = time.time()
+
+    def lastSeen(self, cid):
+        return self._seen.get(cid)
+
+    def takeSeen(self):
+        """ Hand over activity recorded since the last call """
+        seen, self._seen = self._seen, dict()
+        return seen
+
+    def returnSeen(self, seen):
+        """ Give back activity taken by `takeSeen` that couldn't be written """
+        for cid, ts in seen.items():
+            self._seen[cid] = max(self._seen.get(cid, 0), ts)
+
+    def seenEntries(self):
+        return dict([(i['cid'], i.eid) for i in self._db.search(Query().seen.exists())])
+
+    def insertSeen(self, seen):
+        self._db.insert_multiple([dict(cid=cid, seen=ts) for cid, ts in seen.items()])
+
+    def updateSeen(self, eids, seen):
+        def _update(doc):
+            doc['seen'] = max(doc.get('seen', 0), seen.get(doc['cid'], 0))
+        self._db.update(_update, eids=list(eids))
+
+    def retentionScan(self, chat_before, checked_before):
+        return RetentionScan(self, self._db.all(), chat_before, checked_before)
+
+    def _existing(self, eids):
+        existing = set([i.eid for i in self._db.all()])
+        return [i for i in eids if i in existing]
+
+    def stampItems(self, eids, ts=None):
+        if ts is None:
+            ts = time.time()
+        eids = list(eids)
+        try:
+            self._db.update(dict(added=ts), eids=eids)
+        except KeyError:
+            logging.debug("Some entries were removed: {0!s}".format(eids))
+            self._db.update(dict(added=ts), eids=self._existing(eids))
+
+    def removeEntries(self, eids):
+        eids = list(eids)
+        try:
+            self._db.remove(eids=eids)
+        except KeyError:
+            logging.debug("Some entries were already removed: {0!s}".format(eids))
+            self._db.remove(eids=self._existing(eids))
+        self._lists.clear()
+        self._subscribers.clear()
+
     def dumpAll(self):
         l = [(i.eid, i) for i in self._db.all()]
         logging.debug("Store content: {0!s}".format(l))
+
+
+class RetentionScan(object):
+    """ One pass over the store for background maintenance
+
+    The documents are read once and processed in chunks by `step`, so the
+    caller can yield to the event loop in between. `result` returns a dict
+    of abandoned chats (cid -> eids), a list of (list id, eid) of checked
+    items older than `checked_before` and a list of eids of items without
+    any timestamp (stored by older versions).
+    """
+
+    def __init__(self, storage, docs, chat_before, checked_before):
+        self._storage = storage
+        self._docs = docs
+        self._pos = 0
+        self._chat_before = chat_before
+        self._checked_before = checked_before
+        self._activity = dict()
+        self._eids = dict()
+        self._lists = dict()
+        self._stale = list()
+        self._unstamped = list()
+
+    def step(self, count):
+        """ Process up to `count` documents; returns False when done """
+        chunk = self._docs[self._pos:self._pos + count]
+        self._pos += len(chunk)
+        for i in chunk:
+            cid = i.get('cid')
+            if cid is None:
+                continue
+            ts = max(i.get('seen', 0), i.get('added', 0), i.get('checked_at', 0))
+            if ('item' in i) and (ts == 0):
+                self._unstamped.append(i.eid)
+            self._activity[cid] = max(self._activity.get(cid, 0), ts)
+            self._eids.setdefault(cid, list()).append(i.eid)
+            if 'list' in i:
+                self._lists[cid] = i['list']
+            if i.get('checked', 0) == 1:
+                if 0 < i.get('checked_at', i.get('added', 0)) < self._checked_before:
+                    self._stale.append((cid, i.eid))
+        return self._pos < len(self._docs)
+
+    def result(self):
+        activity = dict(self._activity)
+        for cid, ts in self._storage._seen.items():
+            activity[cid] = max(activity.get(cid, 0), ts)
+        # a shared list stays alive as long as any subscriber is active
+        for cid, lid in self._lists.items():
+            activity[lid] = max(activity.get(lid, 0), activity.get(cid, 0))
+        abandoned = { cid : self._eids[cid] for cid, ts in activity.items()
+                      if (0 < ts < self._chat_before) and (cid in self._eids)
+                    }
+        return abandoned, self._stale, self._unstamped
@@ -0,0 +1,128 @@
+import math
+import heapq
+import logging
+import asyncio
+
+
+class TimerWheel(object):
+    """ Coarse grained timer wheel shared by many idle timers
+
+    Timers only record a new deadline on activity. The wheel keeps every
+    timer in the slot it was scheduled for and re-buckets it lazily when that
+    slot comes up, so activity never touches the event loop. Due timers are
+    expired in one batch per tick.
+
+    A timer is any object with the attributes ``deadline`` (loop time or
+    ``None``), ``slot`` (managed by the wheel) and a method ``expire()``.
+    """
+
+    def __init__(self, loop=None, resolution=1.0):
+        self._loop = loop
+        self._resolution = resolution
+        self._slots = dict()   # slot -> set of timers
+        self._heap = list()    # slot numbers (may contain stale entries)
+        self._handle = None
+        self._armed = None     # slot the loop callback is armed for
+
+    @property
+    def loop(self):
+        if self._loop is None:
+            self._loop = asyncio.get_event_loop()
+        return self._loop
+
+    def time(self):
+        return self.loop.time()
+
+    def _slotOf(self, deadline):
+        return int(math.ceil(deadline / self._resolution))
+
+    def schedule(self, timer):
+        """ (Re-)schedule `timer` according to its current deadline """
+        slot = self._slotOf(timer.deadline)
+        if timer.slot == slot:
+            return
+        self._discard(timer)
+        timers = self._slots.get(slot)
+        if timers is None:
+            timers = self._slots[slot] = set()
+            heapq.heappush(self._heap, slot)
+        timers.add(timer)
+        timer.slot = slot
+        self._arm()
+
+    def update(self, timer, deadline):
+        """ Record a new deadline for `timer`
+
+        Later deadlines are only recorded, the timer is moved once its old
+        slot comes up. Earlier deadlines move the timer right away.
+        """
+        timer.deadline = deadline
+        if (timer.slot is None) or (self._slotOf(deadline) < timer.slot):
+            self.schedule(timer)
+
+    def cancel(self, timer):
+        """ Remove `timer` from the wheel; unknown timers are ignored """
+        self._discard(timer)
+        timer.deadline = None
+
+    def _discard(self, timer):
+        if timer.slot is None:
+            return
+        timers = self._slots.get(timer.slot)
+        if timers is not None:
+            timers.discard(timer)
+            if not timers:
+                del self._slots[timer.slot]
+        timer.slot = None
+
+    def _arm(self):
+        while self._heap and (self._heap[0] not in self._slots):
+            heapq.heappop(self._heap)
+        if not self._heap:
+            if self._handle is not None:
+                self._handle.cancel()
+            self._handle = None
+            self._armed = None
+            return
+        slot = self._heap[0]
+        if (self._handle is not None) and (self._armed <= slot):
+            return
+        if self._handle is not None:
+            self._handle.cancel()
+        self._armed = slot
+        self._handle = self.loop.call_at(slot * self._resolution, self._tick)
+
+    def _tick(self):
+        now = self.time()
+        current = int(math.floor(now / self._resolution))
+        if self._armed is not None:
+            # the loop may run us a little early; the armed slot is due anyway
+            current = max(current, self._armed)
+        self._handle = None
+        self._armed = None
+        expired = list()
+        delayed = list()
+        while self._heap and (self._heap[0] <= current):
+            slot = heapq.heappop(self._heap)
+            for timer in self._slots.pop(slot, ()):
+                timer.slot = None
+                if timer.deadline is None:
+                    continue
+                elif timer.deadline > now:
+                    delayed.append(timer)
+                else:
+                    expired.append(timer)
+        for timer in delayed:
+            self.schedule(timer)
+        if expired:
+            logging.debug("Expiring {0} idle timer(s)".format(len(expired)))
+        for timer in expired:
+            timer.deadline = None
+            try:
+                timer.expire()
+            except Exception:
+                logging.exception("Expiring timer {0!r} failed".format(timer))
+        self._arm()
+
+    def __len__(self):
+        return sum(len(i) for i in self._slots.values())